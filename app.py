@@ -1,9 +1,10 @@
 # app.py
+import os
 import re
+from types import MappingProxyType
 import numpy as np
 import pandas as pd
 import streamlit as st
-import plotly.express as px
 import plotly.graph_objects as go
 
 # ----------------------------
@@ -13,71 +14,43 @@ st.set_page_config(page_title="Lebanon Water — Springs & Network", layout="wid
 st.title("Lebanon Water — Springs & Network")
 st.caption("Filter, aggregate, and rank areas to explore seasonal dependence and network condition.")
 
-# ----------------------------
-# Load data (no uploader)
-# ----------------------------
-@st.cache_data
-def load_csv(path: str) -> pd.DataFrame:
-    return pd.read_csv(path)
-
-try:
-    df = load_csv("water_resources.csv")
-except Exception:
-    st.error("Could not load `water_resources.csv`. Make sure it sits next to `app.py` in your repo.")
-    st.stop()
-
-df.columns = [c.strip() for c in df.columns]
-
 # ----------------------------
 # Flexible columns & light cleaning
 # ----------------------------
-def parse_ref_area(s: str):
-    if not isinstance(s, str):
-        return (np.nan, "Other")
-    m = re.match(r"^(.*)_(Governorate|District)$", s.strip())
-    if m:
-        name_raw, a_type = m.groups()
-        return (name_raw.replace("_", " ").strip(), a_type)
-    return (s.replace("_", " ").strip(), "Other")
-
-# If GovernorateName/DistrictName missing, derive from refArea
-if "GovernorateName" not in df.columns or "DistrictName" not in df.columns:
-    if "refArea" in df.columns:
-        area_parsed = df["refArea"].apply(parse_ref_area)
-        df["AreaName"], df["AreaType"] = zip(*area_parsed)
-        if "GovernorateName" not in df.columns:
-            df["GovernorateName"] = np.nan
-        if "DistrictName" not in df.columns:
-            df["DistrictName"] = np.nan
-        df.loc[df["AreaType"] == "Governorate", "GovernorateName"] = df.loc[df["AreaType"] == "Governorate", "AreaName"]
-        df.loc[df["AreaType"] == "District", "DistrictName"] = df.loc[df["AreaType"] == "District", "AreaName"]
-    else:
-        st.error("Missing `GovernorateName`/`DistrictName` and `refArea` — cannot determine geography.")
-        st.stop()
-
-HAS_TOWN = "Town" in df.columns
-if HAS_TOWN:
-    df["Town"] = df["Town"].astype(str).str.strip().str.replace(r"\s+", " ", regex=True)
+# refArea looks like "Mount_Lebanon_Governorate" / "Matn_District"
+REF_AREA_RE = re.compile(r"^(?P<AreaName>.*)_(?P<AreaType>Governorate|District)$")
 
 # Normalize a few governorate spellings
 gov_std = {"North": "North Lebanon", "South": "South Lebanon", "Beqaa": "Bekaa"}
-df["GovernorateName"] = df["GovernorateName"].replace(gov_std)
 
 # ---- District aliases (force a single, clean name) ----
+# Dash variants and mis-decoded bytes are normalized first (see clean_district),
+# so only genuinely different spellings need an alias here
 TARGET_MINIEH = "Minieh - Danniyeh"
-DISTRICT_ALIASES = {
-    "MiniyehâDanniyeh": TARGET_MINIEH,  # en dash
-    "Miniyeh—Danniyeh": TARGET_MINIEH,    # em dash
+DASH_TRANS = str.maketrans({"\u2013": "-", "\u2014": "-", "\u2015": "-"})  # en/em dash, horizontal bar
+DISTRICT_ALIASES = MappingProxyType({
     "Minieh-Danniyeh": TARGET_MINIEH,
-    "MiniyehÃ¢Â€Â“Danniyeh": TARGET_MINIEH,
-    "Minieh—Danniyeh": TARGET_MINIEH,
-    "ZahlÃ©": "Zahle", "Zahlé": "Zahle",
+    "Miniyeh-Danniyeh": TARGET_MINIEH,
+    "Zahlé": "Zahle",
     "Bint Jbail": "Bint Jbeil",
     "Jbeil": "Byblos",
     "Saida": "Sidon",
     "Sour": "Tyre",
-}
-df["DistrictName"] = df["DistrictName"].replace(DISTRICT_ALIASES)
+})
+
+def clean_district(name: str) -> str:
+    # Undo UTF-8 that was read as Latin-1/cp1252 ("ZahlÃ©"), at most twice over
+    for _ in range(2):
+        for enc in ("latin-1", "cp1252"):
+            try:
+                name = name.encode(enc).decode("utf-8")
+                break
+            except UnicodeError:
+                continue
+        else:
+            break
+    name = name.translate(DASH_TRANS)
+    return DISTRICT_ALIASES.get(name, name)
 
 def first_present(frame: pd.DataFrame, *cands):
     for c in cands:
@@ -85,27 +58,11 @@ def first_present(frame: pd.DataFrame, *cands):
             return c
     return None
 
-# Required: springs
-COL_SPRING_PERM = first_present(df, "Total number of permanent water springs", "Permanent springs", "Permanent")
-COL_SPRING_SEAS = first_present(df, "Total number of seasonal water springs",   "Seasonal springs",   "Seasonal")
-if not COL_SPRING_PERM or not COL_SPRING_SEAS:
-    st.error("Missing spring columns (permanent/seasonal).")
-    st.stop()
-
-# Optional: network condition
-COL_STATE_GOOD = first_present(df, "State of the water network - good", "Good %", "Good")
-COL_STATE_ACC  = first_present(df, "State of the water network - acceptable", "Acceptable %", "Acceptable")
-COL_STATE_BAD  = first_present(df, "State of the water network - bad", "Bad %", "Bad")
-
-for c in [COL_SPRING_PERM, COL_SPRING_SEAS, COL_STATE_GOOD, COL_STATE_ACC, COL_STATE_BAD]:
-    if c and c in df.columns:
-        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-
 # ----------------------------
 # Two-bucket tags (Governorates & Districts)
 # ----------------------------
 # Governorates: Urban (Mount Lebanon, North Lebanon, Beirut); Rural/Agri (others below)
-GOV_BUCKET = {
+GOV_BUCKET = MappingProxyType({
     "Beirut": "Urban",
     "Mount Lebanon": "Urban",
     "North Lebanon": "Urban",
@@ -115,52 +72,296 @@ GOV_BUCKET = {
     "El Nabatieh": "Rural/Agri",
     "Akkar": "Rural/Agri",
     "South Lebanon": "Rural/Agri",
-}
+})
 
-URBAN_DISTRICTS = {
+URBAN_DISTRICTS = frozenset({
     "Tripoli", "Sidon", "Tyre", "Baabda", "Metn", "Aley",
     "Keserwan", "Chouf","Zahle", "Byblos","Matn", "Jbeil",
-}
-RURAL_DISTRICTS = {
+})
+RURAL_DISTRICTS = frozenset({
     "Baalbek", "Hermel", "West Bekaa", "Rachaya",
     "Bint Jbeil", "Marjeyoun", "Hasbaya", "Jezzine",
     TARGET_MINIEH,
     "Bcharre", "Koura", "Batroun", "Zgharta", "Akkar"
-}
-
-def area_bucket(row, level):
-    g = str(row.get("GovernorateName", "")).strip()
-    d = str(row.get("DistrictName", "")).strip()
-    if level == "Governorate":
-        return GOV_BUCKET.get(g, "Rural/Agri")
-    if d in URBAN_DISTRICTS:
-        return "Urban"
-    if d in RURAL_DISTRICTS:
-        return "Rural/Agri"
-    return GOV_BUCKET.get(g, "Rural/Agri")
+})
+
+# ----------------------------
+# Load + prepare data (cached; no uploader)
+# ----------------------------
+DATA_PATH = "water_resources.csv"
+LOAD_ERROR = "Could not load `water_resources.csv`. Make sure it sits next to `app.py` in your repo."
+
+class DataError(Exception):
+    pass
+
+def find_columns(frame: pd.DataFrame):
+    return (
+        first_present(frame, "Total number of permanent water springs", "Permanent springs", "Permanent"),
+        first_present(frame, "Total number of seasonal water springs",   "Seasonal springs",   "Seasonal"),
+        first_present(frame, "State of the water network - good", "Good %", "Good"),
+        first_present(frame, "State of the water network - acceptable", "Acceptable %", "Acceptable"),
+        first_present(frame, "State of the water network - bad", "Bad %", "Bad"),
+    )
+
+def clean_frame(path: str) -> pd.DataFrame:
+    # Multithreaded Arrow parser; columns come back numpy-backed as before
+    try:
+        df = pd.read_csv(path, engine="pyarrow")
+    except (OSError, ValueError) as e:  # missing/unreadable file, unparseable CSV
+        raise DataError(LOAD_ERROR) from e
+    df.columns = [c.strip() for c in df.columns]
+
+    # If GovernorateName/DistrictName missing, derive from refArea
+    if "GovernorateName" not in df.columns or "DistrictName" not in df.columns:
+        if "refArea" in df.columns:
+            ref = df["refArea"].str.strip()
+            parts = ref.str.extract(REF_AREA_RE)
+            parts["AreaName"] = parts["AreaName"].fillna(ref).str.replace("_", " ", regex=False).str.strip()
+            df[["AreaName", "AreaType"]] = parts.fillna({"AreaType": "Other"})
+            # Fill each level straight from the parsed names (keeping any existing values elsewhere)
+            for col, a_type in (("GovernorateName", "Governorate"), ("DistrictName", "District")):
+                is_type = df["AreaType"] == a_type
+                df[col] = df["AreaName"].where(is_type, df[col] if col in df.columns else np.nan)
+        else:
+            raise DataError("Missing `GovernorateName`/`DistrictName` and `refArea` — cannot determine geography.")
+
+    if "Town" in df.columns:
+        # split()/join strips and collapses whitespace in one pass per (short) name
+        df["Town"] = df["Town"].astype(str).map(lambda s: " ".join(s.split()))
+
+    # Spelling fixes for both levels in one per-column replace; districts are
+    # resolved once per distinct name, not per row
+    dist_fix = {d: clean_district(d) for d in df["DistrictName"].dropna().unique() if isinstance(d, str)}
+    dist_fix = {d: f for d, f in dist_fix.items() if f != d}
+    df = df.replace({"GovernorateName": gov_std, "DistrictName": dist_fix})
+
+    # Springs are required; network condition is optional
+    col_perm, col_seas, col_good, col_acc, col_bad = find_columns(df)
+    if not col_perm or not col_seas:
+        raise DataError("Missing spring columns (permanent/seasonal).")
+
+    # Narrow numeric columns, halving what the per-area sums stream through:
+    # whole non-negative counts as int32, anything else (e.g. percentages) as float32
+    num_cols = [c for c in (col_perm, col_seas, col_good, col_acc, col_bad) if c and c in df.columns]
+    vals = df[num_cols].apply(pd.to_numeric, errors="coerce").fillna(0).to_numpy(dtype=float)
+    is_count = (vals >= 0).all(axis=0) & (vals <= np.iinfo(np.int32).max).all(axis=0) & (vals == np.floor(vals)).all(axis=0)
+    for c, v, whole in zip(num_cols, vals.T, is_count):
+        df[c] = v.astype(np.int32 if whole else np.float32)
+
+    # Labels as categoricals: filtering and per-area sums work on int codes
+    for c in ("GovernorateName", "DistrictName", "Town"):
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+
+    # Bucket tags for both aggregation levels, so switching level is free.
+    # Tags are resolved once per category into a lookup table, then gathered by
+    # code; the trailing slot is what code -1 (missing name) picks up.
+    gov_lut = np.array(
+        [GOV_BUCKET.get(str(g).strip(), "Rural/Agri") for g in df["GovernorateName"].cat.categories] + ["Rural/Agri"],
+        dtype=object,
+    )
+    dist_lut = np.array(
+        ["Urban" if d in URBAN_DISTRICTS else "Rural/Agri" if d in RURAL_DISTRICTS else None
+         for d in (str(d).strip() for d in df["DistrictName"].cat.categories)] + [None],
+        dtype=object,
+    )
+    gov_tag = gov_lut[df["GovernorateName"].cat.codes.to_numpy()]
+    dist_tag = dist_lut[df["DistrictName"].cat.codes.to_numpy()]
+    # Districts use their own lists first, then fall back to the governorate tag
+    df["GovBucket"] = pd.Categorical(gov_tag)
+    df["DistBucket"] = pd.Categorical(np.where(pd.isna(dist_tag), gov_tag, dist_tag))
+
+    # Keep only what the charts read, so the cached frame and the Parquet
+    # sidecar carry no publisher/source/refArea columns
+    keep = ["GovernorateName", "DistrictName", "Town", "GovBucket", "DistBucket",
+            col_perm, col_seas, col_good, col_acc, col_bad]
+    return df[[c for c in keep if c and c in df.columns]]
+
+@st.cache_data(persist="disk")
+def prepare_frame(path: str, version: float):
+    # `version` is only part of the cache key (see DATA_VERSION below).
+    # The cleaned frame is also kept as a Parquet sidecar, so a cold start
+    # skips CSV parsing and cleaning altogether while the sidecar is current.
+    sidecar = os.path.splitext(path)[0] + ".prepared.parquet"
+    df = None
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= version:
+        try:
+            df = pd.read_parquet(sidecar)
+        except Exception:
+            df = None  # unreadable/truncated sidecar: rebuild it from the CSV below
+    if df is None:
+        df = clean_frame(path)
+        # Write under a private name, then swap it in atomically, so a killed
+        # process or two sessions writing at once never leave a partial sidecar
+        tmp = f"{sidecar}.{os.getpid()}.tmp"
+        try:
+            df.to_parquet(tmp, compression="zstd")
+            os.replace(tmp, sidecar)
+        except Exception:
+            # best-effort: read-only checkout etc. — the cache above still works
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return (df, *find_columns(df), "Town" in df.columns)
+
+@st.cache_resource(max_entries=1)
+def load_frame(path: str, version: float):
+    # st.cache_data unpickles a fresh copy on every call; this hands every rerun
+    # the same object instead. Shared, so the frame must never be written to.
+    # One entry: a new DATA_VERSION evicts the previous frame instead of keeping it.
+    return prepare_frame(path, version)
+
+try:
+    # Newest of the CSV and this script, so editing either the data or the
+    # cleaning rules invalidates the disk cache and the Parquet sidecar
+    DATA_VERSION = max(os.path.getmtime(DATA_PATH), os.path.getmtime(__file__))
+    df, COL_SPRING_PERM, COL_SPRING_SEAS, COL_STATE_GOOD, COL_STATE_ACC, COL_STATE_BAD, HAS_TOWN = load_frame(
+        DATA_PATH, DATA_VERSION
+    )
+except DataError as e:
+    st.error(str(e))
+    st.stop()
+except FileNotFoundError:  # no CSV to take DATA_VERSION from
+    st.error(LOAD_ERROR)
+    st.stop()
+
+SUM_COLS = tuple(c for c in (COL_SPRING_PERM, COL_SPRING_SEAS, COL_STATE_GOOD, COL_STATE_ACC, COL_STATE_BAD) if c)
+
+# ----------------------------
+# Per-area aggregates (all level/profile combinations, built once per data version)
+# ----------------------------
+AREA_PROFILES = {"All areas": None, "Urban only": "Urban", "Agriculture/Rural only": "Rural/Agri"}
+GROUP_LEVELS = {"Governorate": ("GovernorateName", "GovBucket"), "District": ("DistrictName", "DistBucket")}
+
+def aggregate(df: pd.DataFrame, group_col: str, bucket_col: str, keep_bucket, sum_cols: tuple) -> pd.DataFrame:
+    # Everything below works on the int codes and value arrays directly:
+    # no sliced frame, no groupby machinery — just one bincount per column
+    group = df[group_col]
+    n_groups = len(group.cat.categories)
+    codes = group.cat.codes.to_numpy()
+    mask = codes >= 0
+    if keep_bucket is not None:
+        mask &= (df[bucket_col] == keep_bucket).to_numpy()
+    codes = codes[mask]
+
+    present = np.flatnonzero(np.bincount(codes, minlength=n_groups))
+    out = pd.DataFrame({group_col: pd.Categorical.from_codes(present, dtype=group.dtype)})
+    for c in sum_cols:
+        out[c] = np.bincount(codes, weights=df[c].to_numpy()[mask], minlength=n_groups)[present]
+    if "Town" in df.columns:
+        # Unique (area, town) code pairs, counted per area
+        towns = df["Town"].cat.codes.to_numpy()[mask]
+        has_town = towns >= 0
+        n_towns = len(df["Town"].cat.categories)
+        pairs = np.unique(codes[has_town].astype(np.int64) * n_towns + towns[has_town])
+        out["Towns"] = np.bincount(pairs // n_towns, minlength=n_groups)[present]
+    return out
+
+@st.cache_resource(max_entries=1)
+def area_tables(_df: pd.DataFrame, df_version: float, sum_cols: tuple) -> dict:
+    # `_df` is not hashed; `df_version` (CSV mtime) stands in for it in the cache key.
+    # Only 2 levels x 3 profiles exist, so every table is built up front and each
+    # rerun is a dict lookup plus a filter on a few dozen rows. Shared: never mutate.
+    return {
+        (level, profile): aggregate(_df, group_col, bucket_col, keep, sum_cols)
+        for level, (group_col, bucket_col) in GROUP_LEVELS.items()
+        for profile, keep in AREA_PROFILES.items()
+    }
+
+# ----------------------------
+# Chart figures (cached per control state; plain tuples in, shared go.Figure out —
+# st.plotly_chart only serializes them, so nothing ever mutates a cached figure).
+# The key space is user-driven (picks x sort x top-N x mode) and shared by every
+# session, so each cache keeps only the most recent figures.
+# ----------------------------
+@st.cache_resource(max_entries=64)
+def build_pyramid_fig(areas: tuple, perm: tuple, seas: tuple, display_mode: str, x_title: str, group_level: str) -> go.Figure:
+    areas = list(areas)
+    perm = np.asarray(perm, dtype=float)
+    seas = np.asarray(seas, dtype=float)
+
+    max_abs_val = float(np.nanmax(np.concatenate([perm, seas]), initial=0))
+    step_base = 50 if display_mode == "Totals" else 1
+    max_abs = int(np.ceil(max_abs_val / step_base) * step_base) or step_base
+    step    = max(step_base, max_abs // 5)
+    tickvals = np.arange(-max_abs, max_abs + step, step, dtype=np.int64)
+    ticktext = np.char.mod("%d", np.abs(tickvals))
+
+    blue_dark   = "#08306B"
+    blue_medium = "#6BAED6"
+
+    fig_pyr = go.Figure()
+    fig_pyr.add_trace(go.Bar(
+        x=-perm, y=areas, orientation="h",
+        name="Permanent (left)", marker_color=blue_dark, customdata=perm,
+        textposition="outside", cliponaxis=False
+    ))
+    fig_pyr.add_trace(go.Bar(
+        x=seas, y=areas, orientation="h",
+        name="Seasonal (right)", marker_color=blue_medium, customdata=seas,
+        textposition="outside", cliponaxis=False
+    ))
+    # Labels are formatted browser-side (d3-format) from the unsigned values in customdata
+    num_fmt = ",d" if display_mode == "Totals" else ",.2f"
+    fig_pyr.update_traces(
+        marker_line_color="white", marker_line_width=0.8,
+        texttemplate=f"%{{customdata:{num_fmt}}}",
+        hovertemplate=f"%{{y}}: %{{customdata:{num_fmt}}}",
+    )
+    fig_pyr.update_layout(
+        template="plotly_white", barmode="overlay", bargap=0.25,
+        xaxis=dict(
+            title=x_title, range=[-max_abs, max_abs],
+            tickmode="array", tickvals=tickvals.tolist(), ticktext=ticktext.tolist(),
+            zeroline=True, zerolinewidth=2, zerolinecolor="rgba(0,0,0,0.35)"
+        ),
+        yaxis=dict(title=group_level),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
+        margin=dict(l=110, r=40, t=20, b=50)
+    )
+    return fig_pyr
+
+@st.cache_resource(max_entries=64)
+def build_network_fig(areas: tuple, good: tuple, acc: tuple, bad: tuple, group_level: str, show_labels: bool) -> go.Figure:
+    areas = list(areas)
+    fig_net = go.Figure()
+    for name, vals, color in [
+        ("Good %", good, "#2ECC71"),
+        ("Acceptable %", acc, "#F1C40F"),
+        ("Bad %", bad, "#E74C3C"),
+    ]:
+        fig_net.add_trace(go.Bar(
+            x=list(vals), y=areas, orientation="h",
+            name=name, marker_color=color,
+            hovertemplate=f"{group_level}=%{{y}}<br>{name[:-2]}=%{{x}}%<extra></extra>",
+        ))
+    fig_net.update_layout(
+        template="plotly_white", barmode="stack",
+        xaxis=dict(title="Share (%)", range=[0, 100]),
+        yaxis=dict(title=group_level),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0, title_text="Condition"),
+        margin=dict(l=110, r=40, t=20, b=50)
+    )
+    if show_labels:
+        fig_net.update_traces(texttemplate="%{x:.0f}%", textposition="outside", cliponaxis=False)
+    return fig_net
 
 # ----------------------------
 # Sidebar — aggregation & area filter
 # ----------------------------
 st.sidebar.header("Filters")
 
-group_level = st.sidebar.radio("Aggregate by", ["Governorate", "District"], index=0)
-GROUP_COL = "GovernorateName" if group_level == "Governorate" else "DistrictName"
+group_level = st.sidebar.radio("Aggregate by", list(GROUP_LEVELS), index=0)
+GROUP_COL = GROUP_LEVELS[group_level][0]
 
 area_choice = st.sidebar.radio(
     "Area profile (external)",
-    ["All areas", "Urban only", "Agriculture/Rural only"],
+    list(AREA_PROFILES),
     index=0
 )
 
-df["AreaBucket"] = df.apply(lambda r: area_bucket(r, group_level), axis=1)
-
-data0 = df.copy()
-if area_choice != "All areas":
-    keep = "Urban" if area_choice == "Urban only" else "Rural/Agri"
-    data0 = data0[data0["AreaBucket"] == keep]
-
-areas_all = sorted([a for a in data0[GROUP_COL].dropna().unique().tolist() if a])
+area_table = area_tables(df, DATA_VERSION, SUM_COLS)[(group_level, area_choice)]
+# Table rows are already unique and in category (alphabetical) order
+areas_all = [a for a in area_table[GROUP_COL].tolist() if a]
 if len(areas_all) == 0:
     st.warning(
         f"No {group_level.lower()}s match **{area_choice}**. "
@@ -174,8 +375,9 @@ if len(pick_areas) == 0:
     st.stop()
 
 # <-- THIS IS THE PIECE THAT WAS MISSING:
-data = data0[data0[GROUP_COL].isin(pick_areas)].copy()
-if data.empty:
+# Sort/top-N/label widgets below only reorder/trim this small table
+agg = area_table[area_table[GROUP_COL].isin(pick_areas)].reset_index(drop=True)
+if agg.empty:
     st.warning("No rows after filtering. Adjust your selections.")
     st.stop()
 
@@ -196,101 +398,53 @@ def safe_topn_slider(label, n_items, key=None):
         st.stop()
     return st.sidebar.slider(label, min_value=1, max_value=n, value=min(8, n), key=key)
 
-# ----------------------------
-# Pyramid controls (reduced options)
-# ----------------------------
-st.sidebar.markdown("---")
-st.sidebar.subheader("Pyramid sorting")
-sort_opt = st.sidebar.selectbox(
-    "Sort by",
-    [
-        "Total springs",
-        "Seasonal only",
-        "Permanent only",
-    ],
-    index=0,
-)
-ascending = st.sidebar.checkbox("Ascending order", value=False)
-top_n_pyr = safe_topn_slider("Show top-N areas (after sort)", len(pick_areas), key="tn_pyr")
-
-# ----------------------------
-# Network controls
-# ----------------------------
-st.sidebar.markdown("---")
-st.sidebar.subheader("Network sorting")
-net_sort_opt = st.sidebar.selectbox("Sort by", ["Good %", "Bad %", "Acceptable %"], index=0)
-net_ascending = st.sidebar.checkbox("Ascending", value=False, key="net_asc")
-top_n_net = safe_topn_slider("Show top-N areas", len(pick_areas), key="tn_net")
-show_labels_net = st.sidebar.checkbox("Show labels on bars", value=True)
-
 # ----------------------------
 # Viz 1: Pyramid — Permanent vs Seasonal
 # ----------------------------
 st.subheader(f"Permanent vs Seasonal Springs by {group_level}")
 
-spr = data.groupby(GROUP_COL, as_index=False)[[COL_SPRING_PERM, COL_SPRING_SEAS]].sum()
+def per_town(values, n_towns):
+    # Divide only where there are towns; an area with none keeps its (zero) total
+    out = np.array(values, dtype=float)
+    np.divide(out, n_towns, out=out, where=np.asarray(n_towns) > 0)
+    return np.round(out, 2, out=out)
+
+spr = agg[[GROUP_COL, COL_SPRING_PERM, COL_SPRING_SEAS]].copy()
 
 if display_mode == "Per-town average" and HAS_TOWN:
-    town_counts = data.groupby(GROUP_COL, as_index=False)["Town"].nunique().rename(columns={"Town":"Towns"})
-    spr = spr.merge(town_counts, on=GROUP_COL, how="left")
-    spr["Towns"] = spr["Towns"].replace(0, np.nan)
-    spr[COL_SPRING_PERM] = (spr[COL_SPRING_PERM] / spr["Towns"]).round(2)
-    spr[COL_SPRING_SEAS] = (spr[COL_SPRING_SEAS] / spr["Towns"]).round(2)
+    towns = agg["Towns"].to_numpy()
+    spr[COL_SPRING_PERM] = per_town(spr[COL_SPRING_PERM].to_numpy(), towns)
+    spr[COL_SPRING_SEAS] = per_town(spr[COL_SPRING_SEAS].to_numpy(), towns)
     x_title = "Avg springs per town"
 else:
     x_title = "Number of springs"
 
-spr["Total"] = spr[COL_SPRING_PERM] + spr[COL_SPRING_SEAS]
-
-if sort_opt == "Total springs":
-    spr = spr.sort_values("Total", ascending=ascending)
-elif sort_opt == "Seasonal only":
-    spr = spr.sort_values(COL_SPRING_SEAS, ascending=ascending)
-elif sort_opt == "Permanent only":
-    spr = spr.sort_values(COL_SPRING_PERM, ascending=ascending)
-
-spr = spr.tail(top_n_pyr)
-
-areas = spr[GROUP_COL].tolist()
-perm = spr[COL_SPRING_PERM].to_numpy()
-seas = spr[COL_SPRING_SEAS].to_numpy()
-
-max_abs_val = float(max(perm.max() if len(perm) else 0, seas.max() if len(seas) else 0))
-step_base = 50 if display_mode == "Totals" else 1
-max_abs = int(np.ceil(max_abs_val / step_base) * step_base) or step_base
-step    = max(step_base, max_abs // 5)
-tickvals = list(range(-max_abs, max_abs + step, step))
-ticktext = [str(abs(v)) for v in tickvals]
-
-blue_dark   = "#08306B"
-blue_medium = "#6BAED6"
-
-fig_pyr = go.Figure()
-fig_pyr.add_trace(go.Bar(
-    x=-perm, y=areas, orientation="h",
-    name="Permanent (left)", marker_color=blue_dark,
-    text=[f"{v:,.2f}" if display_mode!="Totals" else f"{int(v):,}" for v in perm],
-    textposition="outside", cliponaxis=False
-))
-fig_pyr.add_trace(go.Bar(
-    x=seas, y=areas, orientation="h",
-    name="Seasonal (right)", marker_color=blue_medium,
-    text=[f"{v:,.2f}" if display_mode!="Totals" else f"{int(v):,}" for v in seas],
-    textposition="outside", cliponaxis=False
-))
-fig_pyr.update_traces(marker_line_color="white", marker_line_width=0.8)
-fig_pyr.update_layout(
-    template="plotly_white", barmode="overlay", bargap=0.25,
-    xaxis=dict(
-        title=x_title, range=[-max_abs, max_abs],
-        tickmode="array", tickvals=tickvals, ticktext=ticktext,
-        zeroline=True, zerolinewidth=2, zerolinecolor="rgba(0,0,0,0.35)"
-    ),
-    yaxis=dict(title=group_level),
-    legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
-    margin=dict(l=110, r=40, t=20, b=50)
-)
-st.plotly_chart(fig_pyr, use_container_width=True)
+# Sorting/top-N live in a fragment, so touching them reruns only this chart.
+# The fragment writes its controls straight into the sidebar (Streamlit >= 1.59).
+@st.fragment
+def render_pyramid(spr: pd.DataFrame, x_title: str):
+    st.sidebar.markdown("---")
+    st.sidebar.subheader("Pyramid sorting")
+    sort_opt = st.sidebar.selectbox("Sort by", ["Total springs", "Seasonal only", "Permanent only"], index=0, key="pyr_sort")
+    ascending = st.sidebar.checkbox("Ascending order", value=False, key="pyr_asc")
+    top_n_pyr = safe_topn_slider("Show top-N areas (after sort)", len(spr), key="tn_pyr")
+
+    areas = spr[GROUP_COL].to_numpy()
+    perm = spr[COL_SPRING_PERM].to_numpy()
+    seas = spr[COL_SPRING_SEAS].to_numpy()
+    sort_key = {"Total springs": perm + seas, "Seasonal only": seas, "Permanent only": perm}[sort_opt]
+    # Stable argsort (negated for descending) so tied areas keep their order
+    # across reruns; the last top-N positions are what the chart shows
+    order = np.argsort(sort_key if ascending else -sort_key, kind="stable")[-top_n_pyr:]
+
+    fig_pyr = build_pyramid_fig(
+        tuple(areas[order].tolist()), tuple(perm[order].tolist()), tuple(seas[order].tolist()),
+        display_mode, x_title, group_level,
+    )
+    st.plotly_chart(fig_pyr, use_container_width=True, key="pyr_chart")
+
+render_pyramid(spr, x_title)
+
 with st.expander("💡 Insights (Governorates vs District)"):
     st.markdown("""
 **Governorates insights**
@@ -334,43 +488,36 @@ with st.expander("🏙️ Urban vs 🌾 Agriculture/Rural"):
 st.subheader(f"State of Water Network by {group_level} (100% Stacked)")
 
 if COL_STATE_GOOD and COL_STATE_ACC and COL_STATE_BAD:
-    net = data.groupby(GROUP_COL, as_index=False)[[COL_STATE_GOOD, COL_STATE_ACC, COL_STATE_BAD]].sum()
-
-    vals = net[[COL_STATE_GOOD, COL_STATE_ACC, COL_STATE_BAD]].astype(float)
-    row_sum = vals.sum(axis=1).replace(0, np.nan)
-    net_pct = (vals.div(row_sum, axis=0) * 100).round(1)
-    net_pct[GROUP_COL] = net[GROUP_COL]
-
-    sort_key_map = {"Good %": COL_STATE_GOOD, "Bad %": COL_STATE_BAD, "Acceptable %": COL_STATE_ACC}
-    net_pct = net_pct.sort_values(sort_key_map[net_sort_opt], ascending=net_ascending)
-    net_pct = net_pct.tail(top_n_net)
-
-    nice = {COL_STATE_GOOD: "Good %", COL_STATE_ACC: "Acceptable %", COL_STATE_BAD: "Bad %"}
-    net_pct = net_pct.rename(columns=nice)
-
-    net_long = net_pct.melt(
-        id_vars=GROUP_COL,
-        value_vars=["Good %", "Acceptable %", "Bad %"],
-        var_name="Condition", value_name="Share"
-    )
-
-    fig_net = px.bar(
-        net_long, x="Share", y=GROUP_COL,
-        color="Condition", orientation="h",
-        color_discrete_map={"Good %": "#2ECC71", "Acceptable %": "#F1C40F", "Bad %": "#E74C3C"},
-        category_orders={"Condition": ["Good %", "Acceptable %", "Bad %"]},
-        text="Share" if show_labels_net else None
-    )
-    fig_net.update_layout(
-        template="plotly_white",
-        xaxis=dict(title="Share (%)", range=[0, 100]),
-        yaxis=dict(title=group_level),
-        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
-        margin=dict(l=110, r=40, t=20, b=50)
-    )
-    if show_labels_net:
-        fig_net.update_traces(texttemplate="%{text:.0f}%", textposition="outside", cliponaxis=False)
-    st.plotly_chart(fig_net, use_container_width=True)
+    # Row-normalize on the raw array; areas with no network answers stay NaN
+    # (blank bar) rather than reading as 0%
+    vals = agg[[COL_STATE_GOOD, COL_STATE_ACC, COL_STATE_BAD]].to_numpy(dtype=float)
+    row_sum = vals.sum(axis=1, keepdims=True)
+    pct = np.divide(vals, row_sum, out=np.full_like(vals, np.nan), where=row_sum > 0)
+    pct *= 100
+    np.round(pct, 1, out=pct)
+    net_pct = pd.DataFrame(pct, columns=["Good %", "Acceptable %", "Bad %"])
+    net_pct[GROUP_COL] = agg[GROUP_COL].to_numpy()
+
+    # Sorting/top-N/labels live in a fragment (controls in the sidebar, as above),
+    # so touching them reruns only this chart
+    @st.fragment
+    def render_network(net_pct: pd.DataFrame):
+        st.sidebar.markdown("---")
+        st.sidebar.subheader("Network sorting")
+        net_sort_opt = st.sidebar.selectbox("Sort by", ["Good %", "Bad %", "Acceptable %"], index=0, key="net_sort")
+        net_ascending = st.sidebar.checkbox("Ascending", value=False, key="net_asc")
+        top_n_net = safe_topn_slider("Show top-N areas", len(net_pct), key="tn_net")
+        show_labels_net = st.sidebar.checkbox("Show labels on bars", value=True, key="net_labels")
+
+        # Same stable argsort as the pyramid; NaN rows sort last either way, as before
+        sort_key = net_pct[net_sort_opt].to_numpy()
+        order = np.argsort(sort_key if net_ascending else -sort_key, kind="stable")[-top_n_net:]
+        cols = [net_pct[c].to_numpy()[order].tolist() for c in (GROUP_COL, "Good %", "Acceptable %", "Bad %")]
+
+        fig_net = build_network_fig(*map(tuple, cols), group_level, show_labels_net)
+        st.plotly_chart(fig_net, use_container_width=True, key="net_chart")
+
+    render_network(net_pct)
 else:
     st.info("Network condition columns not found — this chart is disabled for this CSV.")
 